@@ -14,11 +14,22 @@ FitDrip feed builder (UA/RU) for Horoshop.
 """
 
 import json
+import os
 import re
+from functools import cache, lru_cache
+from io import BytesIO
 from pathlib import Path
+from xml.sax.saxutils import escape, quoteattr
 
 import requests
 from lxml import etree as ET
+from requests.adapters import HTTPAdapter
+
+try:
+    # orjson парсит bytes напрямую и в разы быстрее stdlib; но не обязателен
+    import orjson
+except ImportError:
+    orjson = None
 
 # DSN двуязычная выгрузка (как ты давала)
 DSN_URL = "https://dsn.com.ua/content/export/02f6f031be3bbbdac0097758e1aa8dc6.xml"
@@ -34,24 +45,42 @@ CATEGORY_MAP_JSON = TOOLS / "category_map.json"
 OUT_UA = OUT_DIR / "fitdrip_ua.xml"
 OUT_RU = OUT_DIR / "fitdrip_ru.xml"
 
+# компилируем регексы один раз — иначе re.* лезет в кэш на каждом оффере
+_TAIL_RE = re.compile(r"(Штрихкод|Артикул|SKU|Код|Виробник|Производитель)\b")
+_ANIMAL_FLEX_RE = re.compile(r"\bAnimal Flex\b", re.I)
+_PURPOSE_RE = re.compile(r"(для\s+[^\.\!\?]{10,90})", re.I)
+_UNITS_RE = re.compile(r"\b\d+\s?(g|kg|caps|cap|tabs|tab|tablets|ml)\b", re.I)
+_MULTISPACE_RE = re.compile(r"\s{2,}")
+_DOCTYPE_RE = re.compile(rb"<!DOCTYPE[^>]*>")
+
+# один Session на процесс: переиспользуем TCP/TLS-соединение и просим gzip
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+_SESSION.headers["Accept-Encoding"] = "gzip, deflate"
+
 
+@cache
 def load_json(path: Path) -> dict:
-    return json.loads(path.read_text(encoding="utf-8"))
+    raw = path.read_bytes()
+    if orjson is not None:
+        return orjson.loads(raw)
+    # json.loads на bytes пропускает отдельный шаг text-mode декодирования
+    return json.loads(raw)
 
 
-def fetch_xml(url: str) -> ET._ElementTree:
-    r = requests.get(url, timeout=180)
+def fetch_feed(url: str) -> bytes:
+    r = _SESSION.get(url, timeout=180)
     r.raise_for_status()
-    parser = ET.XMLParser(recover=True, huge_tree=True)
-    return ET.fromstring(r.content, parser=parser).getroottree()
+    return r.content
 
 
 def clean_desc(text: str) -> str:
     if not text:
         return ""
-    t = re.sub(r"\s+", " ", str(text)).strip()
+    # split/join быстрее регекса для схлопывания пробелов
+    t = " ".join(text.split())
     # обрезаем хвосты типа "Штрихкод/Артикул/..."
-    t = re.split(r"(Штрихкод|Артикул|SKU|Код|Виробник|Производитель)\b", t, maxsplit=1)[0]
+    t = _TAIL_RE.split(t, maxsplit=1)[0]
     return t.strip()
 
 
@@ -64,10 +93,11 @@ def extract_purpose(desc: str) -> str:
     d = clean_desc(desc)
     if not d:
         return ""
-    m = re.search(r"(для\s+[^\.\!\?]{10,90})", d, flags=re.I)
+    m = _PURPOSE_RE.search(d)
     if m:
         return m.group(1).strip(" -–—:;,.")
-    return " ".join(d.split()[:8]).strip(" -–—:;,.")
+    # maxsplit, чтобы не резать весь (длинный) description ради 8 слов
+    return " ".join(d.split(None, 8)[:8]).strip(" -–—:;,.")
 
 
 def normalize_base_name(name: str) -> str:
@@ -76,8 +106,8 @@ def normalize_base_name(name: str) -> str:
     чтобы потом собрать красивое имя.
     """
     n = (name or "").strip()
-    n = re.sub(r"\b\d+\s?(g|kg|caps|cap|tabs|tab|tablets|ml)\b", "", n, flags=re.I).strip()
-    n = re.sub(r"\s{2,}", " ", n)
+    n = _UNITS_RE.sub("", n).strip()
+    n = _MULTISPACE_RE.sub(" ", n)
     return n
 
 
@@ -96,22 +126,40 @@ UA_TYPE_RULES = [
     (["vitamin d"], "вітамін D"),
 ]
 
+# правила сворачиваем в один regex: одна C-проходка вместо ~30 `in`-проверок,
+# плюс границы слов (чтобы "multi" не ловился внутри "multimineral")
+_UA_LABELS = {}
+_ua_parts = []
+for _i, (_keys, _label) in enumerate(UA_TYPE_RULES):
+    _UA_LABELS[f"t{_i}"] = _label
+    _ua_parts.append(r"\b(?P<t%d>%s)\b" % (_i, "|".join(map(re.escape, _keys))))
+_UA_TYPE_RE = re.compile("|".join(_ua_parts), re.I)
+del _i, _keys, _label, _ua_parts
+
 
 def detect_ua_type(base: str) -> str:
-    lname = (base or "").lower()
-    for keys, label in UA_TYPE_RULES:
-        if any(k in lname for k in keys):
-            return label
-    return ""
+    m = _UA_TYPE_RE.search(base or "")
+    return _UA_LABELS[m.lastgroup] if m else ""
 
 
+# размерные варианты одного SKU часто делят name/description/vendor —
+# кэш срезает всю работу по переименованию для повторов
+@lru_cache(maxsize=4096)
 def rename_ua(name: str, desc: str, vendor: str = "") -> str:
     n = (name or "").strip()
+    nl = n.lower()
+
+    # имя уже с назначением — выходим до любых регексов (дешёвые `in`-проверки)
+    if ("—" in n or ":" in n) and "animal flex" not in nl:
+        return n
 
-    # точечный кейс
-    if re.search(r"\bAnimal Flex\b", n, flags=re.I):
-        n = re.sub(r"(?i)\bAnimal Flex\b", "Animal Flex", n).strip()
-        return f"{n} {vendor}".strip() + " — комплекс для суглобів та зв'язок"
+    # точечный кейс: substring-проверка, регекс только при попадании;
+    # subn заодно отсекает ложные срабатывания типа "Animal Flexx"
+    if "animal flex" in nl:
+        new_n, count = _ANIMAL_FLEX_RE.subn("Animal Flex", n)
+        if count:
+            n = new_n.strip()
+            return f"{n} {vendor}".strip() + " — комплекс для суглобів та зв'язок"
 
     base = normalize_base_name(n)
     v = (vendor or "").strip()
@@ -139,9 +187,12 @@ def rename_ua(name: str, desc: str, vendor: str = "") -> str:
 
 
 # --- RU naming rules (минимально, чтобы был 2-й файл) ---
+@lru_cache(maxsize=4096)
 def rename_ru(name: str, desc: str, vendor: str = "") -> str:
     # если не хочешь русские правки — можно оставить почти как есть
     n = (name or "").strip()
+    if "—" in n or ":" in n:
+        return n
     base = normalize_base_name(n)
     v = (vendor or "").strip()
     if v and v.lower() not in base.lower():
@@ -149,82 +200,176 @@ def rename_ru(name: str, desc: str, vendor: str = "") -> str:
     return n
 
 
-def apply_categories(shop: ET._Element, categories_def: dict, lang: str) -> None:
-    old = shop.find("categories")
-    if old is not None:
-        shop.remove(old)
-
-    cats = ET.SubElement(shop, "categories")
+def write_categories(xf: ET.xmlfile, categories_def: dict, lang: str) -> None:
+    # собираем блок одной строкой и парсим один раз: дешевле, чем сотни
+    # SubElement/set-вызовов через границу Python<->C
+    parts = ["<categories>"]
     for c in categories_def.get("categories", []):
-        el = ET.SubElement(cats, "category")
-        el.set("id", str(c["id"]))
+        attrs = " id=%s" % quoteattr(str(c["id"]))
         parent = str(c.get("parentId", "") or "").strip()
         if parent:
-            el.set("parentId", parent)
-        el.text = c["ua"] if lang == "ua" else c["ru"]
-
-
-def apply_category_ids(offers_node: ET._Element, category_map: dict) -> None:
+            attrs += " parentId=%s" % quoteattr(parent)
+        text = escape(c["ua"] if lang == "ua" else c["ru"])
+        parts.append("<category%s>%s</category>" % (attrs, text))
+    parts.append("</categories>")
+    xf.write(ET.fromstring("".join(parts)))
+
+
+def _extract_fields(offer: ET._Element):
+    """Один проход по детям оффера вместо пяти отдельных find/findtext."""
+    name_el = desc_el = vc_el = vendor_el = cat_el = None
+    for ch in offer.iterchildren():
+        t = ch.tag
+        if t == "name":
+            name_el = ch
+        elif t == "description":
+            desc_el = ch
+        elif t == "vendorCode":
+            vc_el = ch
+        elif t == "vendor":
+            vendor_el = ch
+        elif t == "categoryId":
+            cat_el = ch
+    return name_el, desc_el, vc_el, vendor_el, cat_el
+
+
+def build_feeds(raw: bytes, out_ua: Path = OUT_UA, out_ru: Path = OUT_RU) -> None:
     """
-    Assign <categoryId> by vendorCode (article).
-    If mapping is missing, keep the current <categoryId> (no brand fallback).
+    Потоковая сборка обоих фидов за один проход: iterparse читает фид по
+    одному элементу, два xmlfile-писателя (UA/RU) сразу пишут результат.
+    name/description/vendor каждого оффера читаются один раз на оба языка;
+    в памяти живёт максимум один <offer>.
     """
-    for offer in offers_node.findall("offer"):
-        vendor_code = (offer.findtext("vendorCode") or "").strip()
-        if not vendor_code:
-            continue
-
-        new_cat = category_map.get(vendor_code)
-        if not new_cat:
-            continue
-
-        cat_el = offer.find("categoryId")
-        if cat_el is None:
-            cat_el = ET.SubElement(offer, "categoryId")
-        cat_el.text = str(new_cat)
-
-
-def build(lang: str) -> ET._ElementTree:
+    # пишем во временные файлы и подменяем атомарно: упавшая или пустая
+    # сборка не должна затирать уже опубликованные фиды
+    tmp_ua = out_ua.with_suffix(out_ua.suffix + ".tmp")
+    tmp_ru = out_ru.with_suffix(out_ru.suffix + ".tmp")
+    try:
+        _write_feeds(raw, tmp_ua, tmp_ru)
+    except BaseException:
+        tmp_ua.unlink(missing_ok=True)
+        tmp_ru.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_ua, out_ua)
+    os.replace(tmp_ru, out_ru)
+
+
+def _write_feeds(raw: bytes, out_ua: Path, out_ru: Path) -> None:
     categories_def = load_json(CATEGORIES_JSON)
-    category_map = load_json(CATEGORY_MAP_JSON).get("map", {})
-
-    tree = fetch_xml(DSN_URL)
-    root = tree.getroot()
-
-    shop = root.find("shop")
-    if shop is None:
-        raise RuntimeError("Не найден <shop>")
-
-    apply_categories(shop, categories_def, lang)
-
-    offers_node = shop.find("offers")
-    if offers_node is None:
-        raise RuntimeError("Не найден <offers>")
-
-    apply_category_ids(offers_node, category_map)
-
-    # rename titles
-    for offer in offers_node.findall("offer"):
-        name_el = offer.find("name")
-        if name_el is None:
-            continue
-
-        desc_el = offer.find("description")
-        name_txt = name_el.text or ""
-        desc_txt = (desc_el.text if desc_el is not None else "") or ""
-        vendor = offer.findtext("vendor") or ""
-
-        if lang == "ua":
-            name_el.text = rename_ua(name_txt, desc_txt, vendor)
-        else:
-            name_el.text = rename_ru(name_txt, desc_txt, vendor)
-
-    return tree
+    # ключи чистим и значения приводим к str один раз, а не на каждом оффере
+    category_map = {
+        str(k).strip(): str(v)
+        for k, v in load_json(CATEGORY_MAP_JSON).get("map", {}).items()
+    }
+
+    seen_shop = False
+    seen_offers = False
+    # пишем через крупный буфер, чтобы не дёргать write() на каждый оффер
+    with open(out_ua, "wb", buffering=1 << 20) as f_ua, open(
+        out_ru, "wb", buffering=1 << 20
+    ) as f_ru, ET.xmlfile(f_ua, encoding="utf-8") as xf_ua, ET.xmlfile(
+        f_ru, encoding="utf-8"
+    ) as xf_ru:
+        writers = ((xf_ua, "ua"), (xf_ru, "ru"))
+        dt = _DOCTYPE_RE.search(raw[:1024])
+        for xf, _ in writers:
+            xf.write_declaration()
+            if dt:
+                xf.write_doctype(dt.group(0).decode("utf-8"))
+
+        # открытые через xmlfile контейнеры (yml_catalog/shop/offers)
+        open_elems = []
+        # ID-таблица, entity-подстановка, комментарии и PI фиду не нужны —
+        # отключаем, чтобы libxml2 делал меньше работы на элемент
+        events = ET.iterparse(
+            BytesIO(raw),
+            events=("start", "end"),
+            recover=True,
+            huge_tree=True,
+            collect_ids=False,
+            resolve_entities=False,
+            remove_comments=True,
+            remove_pis=True,
+        )
+        for event, elem in events:
+            if event == "start":
+                if elem.tag == "yml_catalog" and not open_elems:
+                    cms = [xf.element("yml_catalog", dict(elem.attrib)) for xf, _ in writers]
+                elif elem.tag == "shop" and len(open_elems) == 1:
+                    cms = [xf.element("shop", dict(elem.attrib)) for xf, _ in writers]
+                    seen_shop = True
+                elif elem.tag == "offers" and len(open_elems) == 2:
+                    cms = [xf.element("offers", dict(elem.attrib)) for xf, _ in writers]
+                    seen_offers = True
+                else:
+                    continue
+                for cm in cms:
+                    cm.__enter__()
+                open_elems.append((elem.tag, cms))
+                if elem.tag == "shop":
+                    # наши категории вместо исходных
+                    for xf, lang in writers:
+                        write_categories(xf, categories_def, lang)
+                continue
+
+            parent = elem.getparent()
+            if parent is None:
+                continue
+
+            if elem.tag == "offer" and parent.tag == "offers":
+                name_el, desc_el, vc_el, vendor_el, cat_el = _extract_fields(elem)
+
+                # categoryId по vendorCode (артикулу); если маппинга нет —
+                # оставляем исходный categoryId (без фолбэка по бренду)
+                vendor_code = (vc_el.text or "").strip() if vc_el is not None else ""
+                if vendor_code:
+                    new_cat = category_map.get(vendor_code)
+                    if new_cat:
+                        if cat_el is None:
+                            cat_el = ET.SubElement(elem, "categoryId")
+                        cat_el.text = new_cat
+
+                if name_el is None:
+                    xf_ua.write(elem)
+                    xf_ru.write(elem)
+                else:
+                    name_txt = name_el.text or ""
+                    desc_txt = (desc_el.text if desc_el is not None else "") or ""
+                    vendor = (vendor_el.text if vendor_el is not None else "") or ""
+                    name_el.text = rename_ua(name_txt, desc_txt, vendor)
+                    xf_ua.write(elem)
+                    name_el.text = rename_ru(name_txt, desc_txt, vendor)
+                    xf_ru.write(elem)
+            elif parent.tag == "shop" and elem.tag not in ("offers", "categories"):
+                # прочие дети <shop> (currencies и т.п.) — как есть
+                xf_ua.write(elem)
+                xf_ru.write(elem)
+            elif open_elems and elem.tag == open_elems[-1][0]:
+                for cm in open_elems.pop()[1]:
+                    cm.__exit__(None, None, None)
+                continue
+            elif parent.tag != "categories":
+                continue
+
+            # освобождаем уже записанное
+            elem.clear(keep_tail=True)
+            while elem.getprevious() is not None:
+                del parent[0]
+
+        while open_elems:
+            for cm in open_elems.pop()[1]:
+                cm.__exit__(None, None, None)
+
+        # проверяем до закрытия писателей, иначе xmlfile пожалуется первым
+        if not seen_shop:
+            raise RuntimeError("Не найден <shop>")
+        if not seen_offers:
+            raise RuntimeError("Не найден <offers>")
 
 
 def main():
-    build("ua").write(str(OUT_UA), encoding="utf-8", xml_declaration=True)
-    build("ru").write(str(OUT_RU), encoding="utf-8", xml_declaration=True)
+    raw = fetch_feed(DSN_URL)
+    build_feeds(raw)
     print("OK:", OUT_UA, OUT_RU)
 
 